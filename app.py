@@ -1,8 +1,23 @@
+import asyncio
+import contextlib
+from collections import defaultdict
+import hashlib
+import json
+import os
+import re
+import time
+import tempfile
+import diskcache
+import httpx
 import streamlit as st
-from openai import OpenAI
+import openai
+import orjson
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from openpyxl import load_workbook
+from openpyxl.utils.cell import coordinate_from_string, column_index_from_string
+from openpyxl.utils.exceptions import CellCoordinatesException
 import graphviz
-import io
 
 st.set_page_config(page_title="Excel Named Range Visualizer", layout="wide")
 
@@ -17,12 +32,62 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# Initialize OpenAI client
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+# Seconds before an OpenAI HTTP request is abandoned (and retried)
+OPENAI_TIMEOUT = 60.0
+
+# Chat model used for formula documentation and translation
+OPENAI_MODEL = "gpt-4o-mini"
+
+# Upper bound on in-flight OpenAI requests; keep below the account's RPM limit
+MAX_CONCURRENT_REQUESTS = 20
+
+# Seconds between status polls while an OpenAI batch job is running
+BATCH_POLL_INTERVAL = 10
+
+# Minimum seconds between progressive redraws of the AI results table
+PROGRESS_INTERVAL = 0.5
+
+# Token budget for one answer holding both the explanation and the Python translation
+ANSWER_MAX_TOKENS = 1000
+
+# Structured output returned for each formula: explanation plus Python translation
+FORMULA_ANSWER_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "ExcelFormulaDoc",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "doc": {"type": "string"},
+                "py": {"type": "string"},
+            },
+            "required": ["doc", "py"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Uploaded files remembered per cached function; session state holds the current one
+CACHE_MAX_ENTRIES = 16
+
+# --- Completions persisted across reruns and restarts, keyed on the full request body ---
+# One handle per server process; module-level code reruns on every widget interaction
+@st.cache_resource
+def completion_cache():
+    return diskcache.Cache(os.path.join(tempfile.gettempdir(), "openai_cache"))
+
+# --- Parse a single-cell reference like "$B$3" into (row, column) ---
+def parse_cell_ref(cell_ref):
+    try:
+        col, row = coordinate_from_string(cell_ref.replace("$", ""))
+    except CellCoordinatesException:
+        return None
+    return row, column_index_from_string(col)
 
 # --- Extract named references from workbook ---
-@st.cache_data(show_spinner=False)
-def extract_named_references(_wb):
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def extract_named_references(file_hash, _wb):
     named_refs = {}
     for name in _wb.defined_names:
         defined_name = _wb.defined_names[name]
@@ -34,57 +99,278 @@ def extract_named_references(_wb):
                     "ref": ref,
                     "formula": None
                 }
-                try:
-                    sheet = _wb[sheet_name]
-                    cell_ref = ref.split('!')[-1]
-                    cell = sheet[cell_ref]
-                    if cell.data_type == 'f':
-                        named_refs[defined_name.name]["formula"] = cell.value
-                except Exception:
-                    pass
+
+    # Group single-cell targets by sheet and row so each read-only sheet is streamed once
+    # (sheet.cell() re-parses the sheet XML from the top on every call)
+    by_sheet = defaultdict(lambda: defaultdict(list))
+    for name, info in named_refs.items():
+        cell_ref = info["ref"].split('!')[-1]
+        # Multi-cell ranges have no single formula to show; keep only their metadata
+        if ':' in cell_ref:
+            continue
+        coords = parse_cell_ref(cell_ref)
+        if coords and info["sheet"] in _wb.sheetnames:
+            row, column = coords
+            by_sheet[info["sheet"]][row].append((column, name))
+
+    for sheet_name, targets in by_sheet.items():
+        sheet = _wb[sheet_name]
+        min_row, max_row = min(targets), max(targets)
+        columns = [column for row_targets in targets.values() for column, _ in row_targets]
+        min_col = min(columns)
+        rows = sheet.iter_rows(min_row=min_row, max_row=max_row, min_col=min_col, max_col=max(columns))
+        for row, cells in enumerate(rows, start=min_row):
+            for column, name in targets.get(row, ()):
+                cell = cells[column - min_col]
+                if cell.data_type == 'f':
+                    named_refs[name]["formula"] = cell.value
     return named_refs
 
 # --- Detect dependencies between named references ---
-@st.cache_data(show_spinner=False)
-def find_dependencies(named_refs):
-    dependencies = {}
-    for name, info in named_refs.items():
-        formula = info.get("formula", "")
-        if formula:
-            formula = formula.upper()
-            deps = [other for other in named_refs if other != name and other.upper() in formula]
-            dependencies[name] = deps
-        else:
-            dependencies[name] = []
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def find_dependencies(file_hash, _named_refs):
+    dependencies = {name: [] for name in _named_refs}
+    if not _named_refs:
+        return dependencies
+    # Upper-case every name and formula once up front
+    upper_name = {name: name.upper() for name in _named_refs}
+    names_upper = {upper: name for name, upper in upper_name.items()}
+    upper_formula = {
+        name: info["formula"].upper()
+        for name, info in _named_refs.items()
+        if info.get("formula")
+    }
+    # One alternation of every name, longest first; Excel names may contain "." and
+    # backslashes, so match whole names rather than relying on \b word boundaries
+    pattern = re.compile(
+        r"(?<![\w.\\])("
+        + "|".join(re.escape(upper) for upper in sorted(names_upper, key=len, reverse=True))
+        + r")(?![\w.\\])"
+    )
+    for name, formula in upper_formula.items():
+        hits = dict.fromkeys(pattern.findall(formula))
+        hits.pop(upper_name[name], None)
+        dependencies[name] = [names_upper[hit] for hit in hits]
     return dependencies
 
 # --- Create a Graphviz dependency graph ---
+def dot_id(name):
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
 def create_dependency_graph(dependencies):
-    dot = graphviz.Digraph()
-    for ref in dependencies:
-        dot.node(ref)
-    for ref, deps in dependencies.items():
-        for dep in deps:
-            dot.edge(dep, ref)
-    return dot
-
-# --- Call OpenAI GPT for doc and Python formula ---
-@st.cache_data(show_spinner=False)
-def call_openai(prompt, max_tokens=100):
+    # Emit the DOT source in one join rather than one Digraph call per node/edge
+    lines = ["digraph {"]
+    lines += [f"\t{dot_id(ref)}" for ref in dependencies]
+    lines += [f"\t{dot_id(dep)} -> {dot_id(ref)}" for ref, deps in dependencies.items() for dep in deps]
+    lines.append("}")
+    return graphviz.Source("\n".join(lines))
+
+# --- OpenAI client over one pooled keep-alive connection set, scoped to an event loop ---
+# Created per asyncio.run: httpx connections cannot be reused once their loop has closed.
+# Retries are handled by create_completion's backoff policy, so the client's own are off.
+@contextlib.asynccontextmanager
+async def openai_client():
+    limits = httpx.Limits(
+        max_connections=MAX_CONCURRENT_REQUESTS,
+        max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+    )
+    # DefaultAsyncHttpxClient keeps the SDK's transport defaults (e.g. follow_redirects)
+    async with openai.DefaultAsyncHttpxClient(limits=limits, timeout=OPENAI_TIMEOUT) as http_client:
+        yield AsyncOpenAI(api_key=st.secrets["OPENAI_API_KEY"], max_retries=0, http_client=http_client)
+
+# --- Chat completion request body shared by live and batch calls ---
+def chat_request(prompt, max_tokens=ANSWER_MAX_TOKENS):
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.2,
+        "max_tokens": max_tokens,
+        "response_format": FORMULA_ANSWER_FORMAT,
+    }
+
+# --- Split a structured answer into (doc, py) ---
+def parse_answer(text):
+    answer = json.loads(text)
+    return answer["doc"].strip(), answer["py"].strip()
+
+# --- Validate a completion: ((doc, py), raw text to cache), or (row note, None) ---
+# Truncated, refused or malformed answers become a note for that row and are never cached
+def read_answer(content, finish_reason, refusal):
+    if refusal:
+        return f"(Model declined: {refusal})", None
+    if content is None or finish_reason != "stop":
+        return f"(Answer incomplete: {finish_reason})", None
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2,
-            max_tokens=max_tokens
+        return parse_answer(content), content
+    except (json.JSONDecodeError, KeyError, TypeError, AttributeError):
+        return "(Answer was not valid JSON)", None
+
+# --- Persistent cache key: model, prompt, max_tokens and sampling settings ---
+def completion_cache_key(body):
+    return json.dumps(body, sort_keys=True)
+
+# --- Single chat completion, retried with jittered backoff on transient failures ---
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    retry=retry_if_exception_type((
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.InternalServerError,
+    )),
+    reraise=True,
+)
+async def create_completion(client, body, sem):
+    async with sem:
+        response = await client.chat.completions.create(**body)
+    return response.choices[0]
+
+# --- Call OpenAI GPT for doc and Python formula in one structured answer ---
+async def call_openai(client, prompt, sem, max_tokens=ANSWER_MAX_TOKENS):
+    body = chat_request(prompt, max_tokens)
+    key = completion_cache_key(body)
+    cached = completion_cache().get(key)
+    if cached is not None:
+        answer, text = read_answer(cached, "stop", None)
+        if text is not None:
+            return answer
+        # Drop entries written before answers were validated
+        completion_cache().delete(key)
+    choice = await create_completion(client, body, sem)
+    answer, text = read_answer(choice.message.content, choice.finish_reason, choice.message.refusal)
+    if text is not None:
+        completion_cache().set(key, text)
+    return answer
+
+# --- Build one doc+translate prompt per formula, keyed by the formula's index ---
+def build_prompts(formulas):
+    return {
+        str(i): (
+            "For the following Excel formula, reply with JSON where \"doc\" briefly explains "
+            "what it does and \"py\" translates it into a clean, readable Python expression:\n"
+            f"{excel_formula}"
         )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        return f"(Error: {e})"
+        for i, excel_formula in enumerate(formulas)
+    }
 
-# --- Generate AI docs + Python translation ---
-@st.cache_data(show_spinner=False)
-def generate_ai_outputs(named_refs):
+# --- Dispatch every prompt concurrently, reporting answers as they arrive ---
+async def fetch_ai_outputs(prompts, on_result=None):
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def answer(client, custom_id, prompt):
+        return custom_id, await call_openai(client, prompt, sem)
+
+    outputs = {}
+    async with openai_client() as client:
+        answers = [answer(client, custom_id, prompt) for custom_id, prompt in prompts.items()]
+        for next_answer in asyncio.as_completed(answers):
+            custom_id, result = await next_answer
+            outputs[custom_id] = result
+            if on_result:
+                on_result(outputs)
+    return outputs
+
+# --- Describe why one batch record failed, preferring the API's own error message ---
+def batch_error(record, response):
+    body = response.get("body")
+    error = record.get("error") or (body.get("error") if isinstance(body, dict) else None) or body
+    if isinstance(error, dict):
+        error = error.get("message") or error
+    return f"(Error: {error})"
+
+# --- Submit every prompt as one OpenAI batch job and wait for it ---
+async def fetch_ai_outputs_batch(prompts):
+    # Only submit prompts that are not already answered in the persistent cache
+    outputs = {}
+    bodies = {}
+    for custom_id, prompt in prompts.items():
+        body = chat_request(prompt)
+        cached = completion_cache().get(completion_cache_key(body))
+        if cached is not None:
+            answer, text = read_answer(cached, "stop", None)
+            if text is not None:
+                outputs[custom_id] = answer
+                continue
+        bodies[custom_id] = body
+    if not bodies:
+        return outputs
+
+    payload = "\n".join(
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body,
+        })
+        for custom_id, body in bodies.items()
+    ).encode()
+
+    async with openai_client() as client:
+        # Remember submitted jobs so a rerun polls the same batch instead of paying twice
+        batches = st.session_state.setdefault("openai_batches", {})
+        payload_key = hashlib.sha256(payload).hexdigest()
+        if payload_key not in batches:
+            batch_file = await client.files.create(file=("requests.jsonl", payload), purpose="batch")
+            batch = await client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+            batches[payload_key] = batch.id
+
+        with st.status("Waiting for OpenAI batch job...") as status:
+            while True:
+                batch = await client.batches.retrieve(batches[payload_key])
+                if batch.status == "completed":
+                    break
+                if batch.status in ("failed", "expired", "cancelled"):
+                    del batches[payload_key]
+                    raise RuntimeError(f"OpenAI batch {batch.id} {batch.status}")
+                counts = batch.request_counts
+                done = f" ({counts.completed}/{counts.total} done)" if counts else ""
+                status.update(label=f"OpenAI batch job {batch.status}{done}...")
+                await asyncio.sleep(BATCH_POLL_INTERVAL)
+
+            # Successful requests land in the output file, failed ones (4xx, invalid body...) in the error file
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if not file_id:
+                    continue
+                content = await client.files.content(file_id)
+                # Read each record on its own so one bad line only affects its row
+                for line in content.text.splitlines():
+                    try:
+                        record = json.loads(line)
+                        custom_id = record["custom_id"]
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        continue
+                    if custom_id not in bodies:
+                        continue
+                    response = record.get("response") or {}
+                    if response.get("status_code") != 200:
+                        outputs[custom_id] = batch_error(record, response)
+                        continue
+                    try:
+                        choice = response["body"]["choices"][0]
+                        message = choice["message"]
+                    except (KeyError, IndexError, TypeError):
+                        outputs[custom_id] = "(Error: malformed batch response)"
+                        continue
+                    answer, text = read_answer(message.get("content"), choice.get("finish_reason"), message.get("refusal"))
+                    outputs[custom_id] = answer
+                    if text is not None:
+                        completion_cache().set(completion_cache_key(bodies[custom_id]), text)
+            # Forget the finished job: answered prompts are now in the disk cache, so a retry
+            # submits a fresh batch holding only the ones that failed or went missing
+            del batches[payload_key]
+            status.update(label="OpenAI batch job completed", state="complete")
+
+    return {custom_id: outputs.get(custom_id, "(Error: missing from batch output)") for custom_id in prompts}
+
+# --- Assemble table rows; answers still in flight show as "…" ---
+# Outputs map each formula index to (doc, py), or to a note string when it could not be answered
+def build_ai_rows(named_refs, formulas, outputs):
+    index = {excel_formula: i for i, excel_formula in enumerate(formulas)}
     results = []
     for name, info in named_refs.items():
         excel_formula = info.get("formula", "")
@@ -92,10 +378,8 @@ def generate_ai_outputs(named_refs):
             doc = "No formula."
             py = ""
         else:
-            doc_prompt = f"Explain what the following Excel formula does:\n{excel_formula}"
-            py_prompt = f"Translate this Excel formula into a clean, readable Python expression:\n{excel_formula}"
-            doc = call_openai(doc_prompt, max_tokens=100)
-            py = call_openai(py_prompt, max_tokens=100)
+            answer = outputs.get(str(index[excel_formula]), ("…", "…"))
+            doc, py = (answer, "") if isinstance(answer, str) else answer
 
         results.append({
             "Named Reference": name,
@@ -105,42 +389,122 @@ def generate_ai_outputs(named_refs):
         })
     return results
 
+# --- Generate AI docs + Python translation ---
+# Not st.cache_data: it streams partial rows to on_progress, and reuse is already covered
+# by session state per upload and the on-disk completion cache
+# Returns (rows, complete); complete is False when any formula came back as a note
+def generate_ai_outputs(named_refs, use_batch=False, on_progress=None):
+    # Refs often share a formula; ask about each distinct formula once
+    formulas = sorted({info["formula"] for info in named_refs.values() if info.get("formula")})
+    prompts = build_prompts(formulas)
+    if use_batch:
+        outputs = asyncio.run(fetch_ai_outputs_batch(prompts))
+    else:
+        last_redraw = 0.0
+        trailing_redraw = None
+
+        def redraw(outputs):
+            nonlocal last_redraw, trailing_redraw
+            trailing_redraw = None
+            last_redraw = time.monotonic()
+            on_progress(build_ai_rows(named_refs, formulas, outputs))
+
+        def on_result(outputs):
+            nonlocal trailing_redraw
+            if not on_progress:
+                return
+            wait = PROGRESS_INTERVAL - (time.monotonic() - last_redraw)
+            if wait <= 0:
+                if trailing_redraw:
+                    trailing_redraw.cancel()
+                redraw(outputs)
+            elif trailing_redraw is None:
+                # Throttled: redraw when the window closes so answers that arrive just before
+                # a slow (retrying) request still show up instead of waiting for it
+                trailing_redraw = asyncio.get_running_loop().call_later(wait, redraw, outputs)
+
+        outputs = asyncio.run(fetch_ai_outputs(prompts, on_result=on_result))
+    complete = not any(isinstance(answer, str) for answer in outputs.values())
+    return build_ai_rows(named_refs, formulas, outputs), complete
+
 # --- Markdown renderer with safe text wrapping ---
+# Single-pass cell cleanup: flatten newlines and escape pipes that would split the cell
+TABLE_CELL_ESCAPES = str.maketrans({"\n": " ", "|": "\\|"})
+
 def render_markdown_table(rows):
     headers = ["Named Reference", "AI Documentation", "Excel Formula", "Python Formula"]
-    md = "| " + " | ".join(headers) + " |\n"
-    md += "| " + " | ".join(["---"] * len(headers)) + " |\n"
+    lines = [
+        "| " + " | ".join(headers) + " |",
+        "| " + " | ".join(["---"] * len(headers)) + " |",
+    ]
     for row in rows:
-        md += "| " + " | ".join([
-            str(row.get("Named Reference", "") or ""),
-            str(row.get("AI Documentation", "") or "").replace("\n", " "),
-            str(row.get("Excel Formula", "") or "").replace("\n", " "),
-            str(row.get("Python Formula", "") or "").replace("\n", " "),
-        ]) + " |\n"
-    return md
+        lines.append("| " + " | ".join(
+            str(row.get(header, "") or "").translate(TABLE_CELL_ESCAPES) for header in headers
+        ) + " |")
+    return "\n".join(lines) + "\n"
 
 # --- Streamlit UI ---
 st.title("📊 Excel Named Range Dependency Viewer with AI")
 
 uploaded_file = st.file_uploader("Upload an Excel (.xlsx) file", type=["xlsx"])
+use_batch = st.toggle(
+    "Use the OpenAI Batch API (half the cost, results can take up to 24h)",
+    help="Submits every prompt as one offline batch job instead of live requests.",
+)
 
 if uploaded_file:
     try:
-        wb = load_workbook(filename=io.BytesIO(uploaded_file.read()), data_only=False)
+        # The content hash keys the caches below so Streamlit never hashes the workbook or dicts
+        with uploaded_file.getbuffer() as file_bytes:
+            file_hash = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+        # Keep derived results in session state so widget reruns skip the workbook entirely
+        if st.session_state.get("file_hash") != file_hash:
+            with st.status("Opening workbook...") as status:
+                # UploadedFile is already a seekable file-like object; avoid copying it into a second buffer
+                uploaded_file.seek(0)
+                wb = load_workbook(filename=uploaded_file, data_only=False, read_only=True, keep_links=False)
+                status.update(label="Extracting named references...")
+                named_refs = extract_named_references(file_hash, _wb=wb)
+                wb.close()
+                status.update(label="Detecting dependencies...")
+                dependencies = find_dependencies(file_hash, named_refs)
+                status.update(label=f"Parsed {len(named_refs)} named references", state="complete", expanded=False)
+            st.session_state.update(
+                file_hash=file_hash,
+                named_refs=named_refs,
+                named_refs_json=orjson.dumps(named_refs, option=orjson.OPT_INDENT_2).decode(),
+                dependencies=dependencies,
+                ai_rows={},
+            )
+        named_refs = st.session_state.named_refs
 
         st.subheader("📌 Named References Found")
-        named_refs = extract_named_references(_wb=wb)
-        st.json(named_refs)
+        # Serialized once per upload; collapsed so big workbooks don't lay out on every rerun
+        with st.expander(f"{len(named_refs)} named references", expanded=len(named_refs) <= 50):
+            st.code(st.session_state.named_refs_json, language="json")
 
         st.subheader("🔗 Dependency Graph")
-        dependencies = find_dependencies(named_refs)
-        dot = create_dependency_graph(dependencies)
+        dot = create_dependency_graph(st.session_state.dependencies)
         st.graphviz_chart(dot)
 
         st.subheader("🧠 AI-Generated Documentation and Python Translation")
-        with st.spinner("Asking GPT for documentation and conversions..."):
-            table_rows = generate_ai_outputs(named_refs)
-            st.markdown(render_markdown_table(table_rows), unsafe_allow_html=True)
+        table = st.empty()
+        ai_rows = st.session_state.ai_rows
+        if use_batch not in ai_rows:
+            with st.spinner("Asking GPT for documentation and conversions..."):
+                ai_rows[use_batch] = generate_ai_outputs(
+                    named_refs,
+                    use_batch=use_batch,
+                    on_progress=lambda partial: table.markdown(render_markdown_table(partial), unsafe_allow_html=True),
+                )
+        rows, complete = ai_rows[use_batch]
+        table.markdown(render_markdown_table(rows), unsafe_allow_html=True)
+
+        # Failure notes stay until asked; answered formulas come back from the disk cache on retry
+        if not complete and st.button("Retry failed rows"):
+            del ai_rows[use_batch]
+            st.rerun()
 
     except Exception as e:
         st.error(f"⚠️ Failed to process file: {e}")